@@ -0,0 +1,230 @@
+import time
+import json
+import hmac
+import socket
+import bisect
+import hashlib
+import logging
+import threading
+from typing import Dict, List, Tuple, Any
+
+logger = logging.getLogger(__name__)
+
+OP_JOIN = 'j'
+OP_LEAVE = 'l'
+DIGEST_SIZE = 32
+
+
+def parse_cluster_nodes(cfg_value: str) -> Dict[str, Tuple[str, int]]:
+    nodes = {}
+    for part in cfg_value.replace(',', ' ').split():
+        try:
+            node_id, addr = part.split('=', 1)
+            host, port = addr.rsplit(':', 1)
+            nodes[node_id.strip()] = (host.strip(), int(port))
+        except ValueError:
+            logger.warning(f"Некорректный узел кластера: {part}")
+    return nodes
+
+
+class HashRing:
+    def __init__(self, node_ids: List[str], vnodes: int = 64):
+        self.ring = []
+        for node_id in node_ids:
+            for i in range(vnodes):
+                self.ring.append((self._hash(f"{node_id}#{i}".encode()), node_id))
+        self.ring.sort()
+        self.keys = [h for h, _ in self.ring]
+
+    @staticmethod
+    def _hash(data: bytes) -> int:
+        return int.from_bytes(hashlib.md5(data).digest()[:8], 'big')
+
+    def owner(self, key: bytes) -> str:
+        if not self.ring:
+            return None
+        i = bisect.bisect(self.keys, self._hash(key)) % len(self.ring)
+        return self.ring[i][1]
+
+
+class ClusterNode:
+    def __init__(self, config: Dict, db):
+        self.cfg = {
+            'node_id': '',
+            'nodes': {},
+            'secret': '',
+            'bind_host': '',
+            'flush_interval': 1.0,
+            'node_timeout': 10,
+            'batch_size': 200,
+            'vnodes': 64
+        }
+        self.cfg.update(config)
+        self.db = db
+        self.node_id = self.cfg['node_id']
+        self.peers = {k: v for k, v in self.cfg['nodes'].items() if k != self.node_id}
+        self.lock = threading.Lock()
+        self.pending = {}
+        self.last_seen = {}
+        self.last_ts = {}
+        self.sent_ts = 0.0
+        self.ring_nodes = None
+        self.ring = None
+        self.sock = None
+        self.counters = {'sent': 0, 'received': 0, 'relayed': 0, 'applied': 0, 'rejected': 0}
+
+    def start(self) -> None:
+        host, port = self.cfg['nodes'][self.node_id]
+        host = self.cfg['bind_host'] or host
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.sock.bind((host, port))
+        threading.Thread(target=self._receive_loop, daemon=True, name='cluster_receive').start()
+        threading.Thread(target=self._flush_loop, daemon=True, name='cluster_flush').start()
+        logger.info(f"Узел кластера {self.node_id} слушает {host}:{port}, соседи: {list(self.peers)}")
+
+    def alive_nodes(self) -> List[str]:
+        now = time.time()
+        with self.lock:
+            alive = [n for n, seen in self.last_seen.items() if now - seen <= self.cfg['node_timeout']]
+        return sorted(alive + [self.node_id])
+
+    def owner(self, info_hash: bytes) -> str:
+        nodes = self.alive_nodes()
+        if nodes != self.ring_nodes:
+            self.ring = HashRing(nodes, self.cfg['vnodes'])
+            self.ring_nodes = nodes
+        return self.ring.owner(info_hash)
+
+    def publish(self, op: str, info_hash: bytes, ip: str, port: int, left: int, update_time: int) -> None:
+        # Повторные анонсы одного пира до отправки схлопываются в одну дельту
+        with self.lock:
+            self.pending[(info_hash, ip, port)] = [op, info_hash.hex(), ip, port, left, update_time]
+
+    def _flush_loop(self) -> None:
+        while True:
+            time.sleep(self.cfg['flush_interval'])
+            try:
+                self.flush()
+            except Exception as e:
+                logger.error(f"Ошибка отправки дельт кластера: {e}")
+
+    def flush(self) -> None:
+        with self.lock:
+            pending, self.pending = self.pending, {}
+        by_owner = {}
+        for key, delta in pending.items():
+            by_owner.setdefault(self.owner(key[0]), []).append(delta)
+
+        to_owner = {node_id: [] for node_id in self.peers}
+        to_all = []
+        for node_id, deltas in by_owner.items():
+            if node_id == self.node_id:
+                to_all.extend(deltas)
+            else:
+                to_owner[node_id].extend(deltas)
+        for node_id in self.peers:
+            if to_all:
+                self._send(node_id, to_all, True)
+            # Пустая пачка служит heartbeat'ом
+            self._send(node_id, to_owner[node_id], False)
+
+    def _send(self, node_id: str, deltas: List[List[Any]], relay: bool) -> None:
+        size = self.cfg['batch_size']
+        chunks = [deltas[i:i + size] for i in range(0, len(deltas), size)] or [[]]
+        for chunk in chunks:
+            # Метки времени отправителя строго возрастают: по ним получатель отбрасывает повторы
+            with self.lock:
+                self.sent_ts = max(time.time(), self.sent_ts + 1e-6)
+                ts = self.sent_ts
+            payload = json.dumps({'node': self.node_id, 'ts': ts, 'relay': relay, 'deltas': chunk}).encode()
+            digest = hmac.new(self.cfg['secret'].encode(), payload, hashlib.sha256).digest()
+            try:
+                self.sock.sendto(digest + payload, self.peers[node_id])
+                with self.lock:
+                    self.counters['sent'] += len(chunk)
+            except OSError as e:
+                logger.debug(f"Узел {node_id} недоступен: {e}")
+
+    def _receive_loop(self) -> None:
+        while True:
+            try:
+                data, addr = self.sock.recvfrom(65535)
+                self.receive(data)
+            except Exception as e:
+                logger.error(f"Ошибка приема дельт кластера: {e}")
+
+    def receive(self, data: bytes) -> None:
+        digest, payload = data[:DIGEST_SIZE], data[DIGEST_SIZE:]
+        expected = hmac.new(self.cfg['secret'].encode(), payload, hashlib.sha256).digest()
+        if not hmac.compare_digest(digest, expected):
+            with self.lock:
+                self.counters['rejected'] += 1
+            logger.warning("Отброшен пакет кластера с неверной подписью")
+            return
+        message = json.loads(payload)
+        origin = message['node']
+        if origin not in self.peers:
+            with self.lock:
+                self.counters['rejected'] += 1
+            return
+        # Пакет должен быть свежим и новее последнего принятого от этого узла,
+        # иначе повтор или переупорядочивание вернёт ушедшего пира
+        ts = float(message.get('ts', 0))
+        with self.lock:
+            stale = abs(time.time() - ts) > self.cfg['node_timeout'] or ts <= self.last_ts.get(origin, 0.0)
+            if stale:
+                self.counters['rejected'] += 1
+            else:
+                self.last_ts[origin] = ts
+        if stale:
+            logger.warning(f"Отброшен устаревший или повторный пакет кластера от {origin}")
+            return
+        deltas = message['deltas']
+        with self.lock:
+            self.last_seen[origin] = time.time()
+            self.counters['received'] += len(deltas)
+        if not deltas:
+            return
+        self.apply(deltas)
+        if not message['relay']:
+            # Владелец хэша раздает дельты остальным узлам
+            for node_id in self.peers:
+                if node_id != origin:
+                    self._send(node_id, deltas, True)
+            with self.lock:
+                self.counters['relayed'] += len(deltas)
+
+    def apply(self, deltas: List[List[Any]]) -> None:
+        joins = []
+        leaves = []
+        for op, info_hash_hex, ip, port, left, update_time in deltas:
+            row = (bytes.fromhex(info_hash_hex), ip, int(port), int(left), int(update_time))
+            if op == OP_LEAVE:
+                leaves.append((row[0], row[1], row[2], row[4]))
+            else:
+                joins.append(row)
+        if joins:
+            self.db.query_many(
+                "INSERT INTO tracker (info_hash, ip, port, left, update_time) VALUES (?, ?, ?, ?, ?) "
+                "ON CONFLICT (info_hash, ip, port) DO UPDATE SET left = excluded.left, update_time = excluded.update_time "
+                "WHERE excluded.update_time >= tracker.update_time",
+                joins
+            )
+        if leaves:
+            self.db.query_many(
+                "DELETE FROM tracker WHERE info_hash = ? AND ip = ? AND port = ? AND update_time <= ?",
+                leaves
+            )
+        with self.lock:
+            self.counters['applied'] += len(deltas)
+
+    def stats(self) -> Dict[str, Any]:
+        alive = self.alive_nodes()
+        with self.lock:
+            return {
+                'node_id': self.node_id,
+                'nodes': len(self.cfg['nodes']),
+                'alive': alive,
+                'pending': len(self.pending),
+                **self.counters
+            }
@@ -0,0 +1,55 @@
+import threading
+from typing import Any, Callable, Dict, Hashable, Tuple
+
+
+class _Call:
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class SingleFlight:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.calls = {}
+        self.leaders = 0
+        self.coalesced = 0
+
+    def do(self, key: Hashable, fn: Callable[[], Any]) -> Tuple[Any, bool]:
+        # Одновременные запросы с одним ключом ждут результат первого
+        with self.lock:
+            call = self.calls.get(key)
+            shared = call is not None
+            if shared:
+                self.coalesced += 1
+            else:
+                call = self.calls[key] = _Call()
+                self.leaders += 1
+
+        if not shared:
+            try:
+                call.result = fn()
+            except BaseException as e:
+                # Ожидающие должны упасть явно даже при KeyboardInterrupt/SystemExit у лидера
+                call.error = e
+                raise
+            finally:
+                with self.lock:
+                    del self.calls[key]
+                call.done.set()
+            return call.result, False
+
+        call.done.wait()
+        if call.error is not None:
+            # У каждого ожидающего потока своё исключение, чтобы не смешивать трассировки
+            raise RuntimeError(f"Общий запрос завершился ошибкой: {call.error!r}") from call.error
+        return call.result, True
+
+    def stats(self) -> Dict[str, int]:
+        with self.lock:
+            return {
+                'leaders': self.leaders,
+                'coalesced': self.coalesced,
+                'in_flight': len(self.calls)
+            }
@@ -50,6 +50,18 @@ class SQLiteCommon:
                 logger.error(f"Ошибка выполнения запроса: {e}")
                 raise
 
+    def query_many(self, query: str, seq_of_params: List[tuple]) -> None:
+        with self.get_connection() as conn:
+            try:
+                conn.execute("BEGIN")
+                conn.executemany(query, seq_of_params)
+                conn.execute("COMMIT")
+            except Exception as e:
+                if conn.in_transaction:
+                    conn.execute("ROLLBACK")
+                logger.error(f"Ошибка выполнения пакетного запроса: {e}")
+                raise
+
     def fetch_rowset(self, query: str, params: tuple = None) -> List[Dict]:
         return self.query(query, params)
 
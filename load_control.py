@@ -0,0 +1,178 @@
+import time
+import math
+import threading
+from collections import OrderedDict
+from typing import Dict, Any, List
+
+
+class LoadController:
+    def __init__(self, config: Dict):
+        self.cfg = {
+            'enabled': True,
+            'max_rps': 200.0,
+            'max_inflight': 32,
+            'max_db_latency': 0.2,
+            'stretch_start': 0.5,
+            'shed_threshold': 1.0,
+            'max_interval_factor': 2.0,
+            'large_swarm': 500,
+            'rate_window': 10,
+            'db_latency_alpha': 0.2,
+            'db_latency_half_life': 5.0,
+            'probe_every': 20,
+            'snapshot_ttl': 300,
+            'snapshot_max': 10000
+        }
+        self.cfg.update(config)
+        self.lock = threading.Lock()
+        self.inflight = 0
+        self.db_latency = 0.0
+        self.db_latency_at = time.monotonic()
+        self.buckets = {}
+        self.stretched_until = 0.0
+        self.snapshots = OrderedDict()
+        self.deferred = {}
+        self.shed_count = 0
+        self.stretch_count = 0
+
+    def begin(self) -> None:
+        now = int(time.time())
+        with self.lock:
+            self.inflight += 1
+            self.buckets[now] = self.buckets.get(now, 0) + 1
+            if len(self.buckets) > self.cfg['rate_window'] * 2:
+                oldest = now - self.cfg['rate_window']
+                for second in [s for s in self.buckets if s <= oldest]:
+                    del self.buckets[second]
+
+    def end(self) -> None:
+        with self.lock:
+            self.inflight = max(self.inflight - 1, 0)
+
+    def _decayed_db_latency(self, now: float) -> float:
+        # Без новых замеров задержка затухает, иначе одна медленная запись держит режим перегрузки вечно
+        elapsed = max(now - self.db_latency_at, 0.0)
+        return self.db_latency * 0.5 ** (elapsed / self.cfg['db_latency_half_life'])
+
+    def observe_db(self, seconds: float) -> None:
+        alpha = self.cfg['db_latency_alpha']
+        now = time.monotonic()
+        with self.lock:
+            self.db_latency = alpha * seconds + (1 - alpha) * self._decayed_db_latency(now)
+            self.db_latency_at = now
+
+    def request_rate(self) -> float:
+        now = int(time.time())
+        window = self.cfg['rate_window']
+        with self.lock:
+            total = sum(c for s, c in self.buckets.items() if now - window < s <= now)
+        return total / window
+
+    def load_factor(self) -> float:
+        if not self.cfg['enabled']:
+            return 0.0
+        rate = self.request_rate()
+        with self.lock:
+            inflight = self.inflight
+            db_latency = self._decayed_db_latency(time.monotonic())
+        return max(
+            rate / self.cfg['max_rps'],
+            inflight / self.cfg['max_inflight'],
+            db_latency / self.cfg['max_db_latency']
+        )
+
+    def should_shed(self) -> bool:
+        if not self.cfg['enabled']:
+            return False
+        if self.load_factor() < self.cfg['shed_threshold']:
+            return False
+        with self.lock:
+            self.shed_count += 1
+            # Часть запросов пропускается к БД, чтобы обновлять замер задержки
+            if self.cfg['probe_every'] and self.shed_count % self.cfg['probe_every'] == 0:
+                return False
+        return True
+
+    def interval(self, base: int, swarm_size: int = 0) -> int:
+        start = self.cfg['stretch_start']
+        threshold = self.cfg['shed_threshold']
+        pressure = (self.load_factor() - start) / max(threshold - start, 1e-6)
+        pressure = min(max(pressure, 0.0), 1.0)
+        if pressure == 0.0:
+            return base
+        swarm_weight = min(swarm_size / self.cfg['large_swarm'], 1.0) if self.cfg['large_swarm'] else 1.0
+        factor = 1 + pressure * (self.cfg['max_interval_factor'] - 1) * (0.5 + 0.5 * swarm_weight)
+        with self.lock:
+            self.stretch_count += 1
+            self.stretched_until = time.time() + base * self.cfg['max_interval_factor']
+        return int(math.ceil(base * factor))
+
+    def peer_window(self, base: int) -> int:
+        # Пока действуют растянутые интервалы, клиенты вправе молчать дольше base
+        if time.time() < self.stretched_until:
+            return int(base * self.cfg['max_interval_factor'])
+        return base
+
+    def remember(self, info_hash: bytes, complete: int, incomplete: int, peers: List[Dict[str, Any]]) -> None:
+        # Снимки нужны только на случай перегрузки, при низкой нагрузке память на них не тратится
+        if not self.cfg['enabled'] or self.load_factor() <= self.cfg['stretch_start']:
+            return
+        compact_peers = tuple((peer['ip'], peer['port']) for peer in peers)
+        with self.lock:
+            self.snapshots[info_hash] = (time.time(), complete, incomplete, compact_peers)
+            self.snapshots.move_to_end(info_hash)
+            while len(self.snapshots) > self.cfg['snapshot_max']:
+                self.snapshots.popitem(last=False)
+
+    def degraded_response(self, info_hash: bytes, base: int) -> Dict[str, Any]:
+        interval = int(base * self.cfg['max_interval_factor'])
+        now = time.time()
+        with self.lock:
+            snapshot = self.snapshots.get(info_hash)
+            if snapshot and now - snapshot[0] > self.cfg['snapshot_ttl']:
+                del self.snapshots[info_hash]
+                snapshot = None
+            self.stretched_until = now + interval
+        output = {
+            'interval': interval,
+            'min interval': interval // 2,
+            'complete': 0,
+            'incomplete': 0,
+            'peers': []
+        }
+        if snapshot:
+            _, output['complete'], output['incomplete'], compact_peers = snapshot
+            output['peers'] = [{'ip': ip, 'port': port} for ip, port in compact_peers]
+        return output
+
+    def defer(self, info_hash: bytes, ip: str, port: int, left: int, update_time: int, stopped: bool) -> None:
+        # Пир, получивший упрощённый ответ, записывается позже одной пачкой, иначе он выпадет из раздачи
+        key = (info_hash, ip, port)
+        with self.lock:
+            if stopped:
+                self.deferred.pop(key, None)
+            elif key in self.deferred or len(self.deferred) < self.cfg['snapshot_max']:
+                self.deferred[key] = (info_hash, ip, port, left, update_time)
+
+    def take_deferred(self) -> List[tuple]:
+        with self.lock:
+            if not self.deferred:
+                return []
+            deferred, self.deferred = self.deferred, {}
+        return list(deferred.values())
+
+    def stats(self) -> Dict[str, Any]:
+        load = self.load_factor()
+        rate = self.request_rate()
+        with self.lock:
+            return {
+                'enabled': self.cfg['enabled'],
+                'load_factor': round(load, 2),
+                'request_rate': round(rate, 1),
+                'inflight': self.inflight,
+                'db_latency_ms': round(self._decayed_db_latency(time.monotonic()) * 1000, 1),
+                'shed_count': self.shed_count,
+                'stretch_count': self.stretch_count,
+                'snapshots': len(self.snapshots),
+                'deferred': len(self.deferred)
+            }
@@ -1,6 +1,10 @@
 from flask import Flask, request, Response, render_template, redirect, url_for, session, flash
 from tracker import *
 from db_handlers import SQLiteCommon
+from load_control import LoadController
+from coalesce import SingleFlight
+from profiler import SamplingProfiler, ProfilerBusy
+from cluster import ClusterNode, parse_cluster_nodes, OP_JOIN, OP_LEAVE
 from logging.handlers import RotatingFileHandler
 import logging
 import os
@@ -66,6 +70,28 @@ TRACKER_PEER_CLEANUP_PERIOD = int(os.getenv('TRACKER_PEER_CLEANUP_PERIOD', 600))
 TRACKER_DEBUG = os.getenv('TRACKER_DEBUG', 'true').lower() == 'true'
 TRACKER_USE_RELOADER = os.getenv('TRACKER_USE_RELOADER', 'true').lower() == 'true'
 
+TRACKER_LOAD_CONTROL = os.getenv('TRACKER_LOAD_CONTROL', 'true').lower() == 'true'
+TRACKER_LOAD_MAX_RPS = float(os.getenv('TRACKER_LOAD_MAX_RPS', 200))
+TRACKER_LOAD_MAX_INFLIGHT = int(os.getenv('TRACKER_LOAD_MAX_INFLIGHT', 32))
+TRACKER_LOAD_MAX_DB_LATENCY_MS = float(os.getenv('TRACKER_LOAD_MAX_DB_LATENCY_MS', 200))
+TRACKER_LOAD_STRETCH_START = float(os.getenv('TRACKER_LOAD_STRETCH_START', 0.5))
+TRACKER_LOAD_SHED_THRESHOLD = float(os.getenv('TRACKER_LOAD_SHED_THRESHOLD', 1.0))
+TRACKER_LOAD_MAX_INTERVAL_FACTOR = float(os.getenv('TRACKER_LOAD_MAX_INTERVAL_FACTOR', 2.0))
+TRACKER_LOAD_LARGE_SWARM = int(os.getenv('TRACKER_LOAD_LARGE_SWARM', 500))
+TRACKER_LOAD_SNAPSHOT_TTL = int(os.getenv('TRACKER_LOAD_SNAPSHOT_TTL', 300))
+
+TRACKER_ANNOUNCE_COALESCE = os.getenv('TRACKER_ANNOUNCE_COALESCE', 'true').lower() == 'true'
+
+PROFILER_MAX_SECONDS = int(os.getenv('PROFILER_MAX_SECONDS', 30))
+PROFILER_MAX_OVERHEAD = float(os.getenv('PROFILER_MAX_OVERHEAD', 0.05))
+
+TRACKER_CLUSTER_NODE_ID = os.getenv('TRACKER_CLUSTER_NODE_ID', '')
+TRACKER_CLUSTER_NODES = os.getenv('TRACKER_CLUSTER_NODES', '')
+TRACKER_CLUSTER_SECRET = os.getenv('TRACKER_CLUSTER_SECRET', '')
+TRACKER_CLUSTER_BIND_HOST = os.getenv('TRACKER_CLUSTER_BIND_HOST', '')
+TRACKER_CLUSTER_FLUSH_INTERVAL = float(os.getenv('TRACKER_CLUSTER_FLUSH_INTERVAL', 1.0))
+TRACKER_CLUSTER_NODE_TIMEOUT = int(os.getenv('TRACKER_CLUSTER_NODE_TIMEOUT', 10))
+
 LOGGING_LEVEL = os.getenv('LOGGING_LEVEL', 'INFO')
 LOGGING_LOG_FILE = os.getenv('LOGGING_LOG_FILE', os.path.join(DATA_DIR, 'tracker.log'))
 LOGGING_MAX_BYTES = int(os.getenv('LOGGING_MAX_BYTES', 5242880))
@@ -203,6 +229,44 @@ default_cfg = {
 db = SQLiteCommon({**default_cfg, **tr_cfg.tr_db})
 logger.info(f"База данных SQLite инициализирована: {DB_FILE_PATH}")
 
+# Растянутый интервал не должен превышать время жизни пира, иначе его удалит очистка
+load = LoadController({
+    'enabled': TRACKER_LOAD_CONTROL,
+    'max_rps': TRACKER_LOAD_MAX_RPS,
+    'max_inflight': TRACKER_LOAD_MAX_INFLIGHT,
+    'max_db_latency': TRACKER_LOAD_MAX_DB_LATENCY_MS / 1000,
+    'stretch_start': TRACKER_LOAD_STRETCH_START,
+    'shed_threshold': TRACKER_LOAD_SHED_THRESHOLD,
+    'max_interval_factor': min(max(TRACKER_LOAD_MAX_INTERVAL_FACTOR, 1.0), max(float(TRACKER_PEER_EXPIRE_FACTOR), 2) - 0.5),
+    'large_swarm': TRACKER_LOAD_LARGE_SWARM,
+    'snapshot_ttl': TRACKER_LOAD_SNAPSHOT_TTL
+})
+logger.info(f"Контроль нагрузки: {'включен' if TRACKER_LOAD_CONTROL else 'выключен'}")
+
+announce_flights = SingleFlight()
+
+profiler = SamplingProfiler({
+    'max_seconds': PROFILER_MAX_SECONDS,
+    'max_overhead': PROFILER_MAX_OVERHEAD
+})
+
+cluster = None
+if TRACKER_CLUSTER_NODE_ID:
+    cluster_nodes = parse_cluster_nodes(TRACKER_CLUSTER_NODES)
+    if TRACKER_CLUSTER_NODE_ID not in cluster_nodes:
+        raise ValueError(f'TRACKER_CLUSTER_NODE_ID {TRACKER_CLUSTER_NODE_ID} not found in TRACKER_CLUSTER_NODES')
+    if not TRACKER_CLUSTER_SECRET:
+        raise ValueError('TRACKER_CLUSTER_SECRET is required in cluster mode')
+    cluster = ClusterNode({
+        'node_id': TRACKER_CLUSTER_NODE_ID,
+        'nodes': cluster_nodes,
+        'secret': TRACKER_CLUSTER_SECRET,
+        'bind_host': TRACKER_CLUSTER_BIND_HOST,
+        'flush_interval': TRACKER_CLUSTER_FLUSH_INTERVAL,
+        'node_timeout': TRACKER_CLUSTER_NODE_TIMEOUT
+    }, db)
+    logger.info(f"Режим кластера: узел {TRACKER_CLUSTER_NODE_ID}, всего узлов: {len(cluster_nodes)}")
+
 def cleanup_dead_peers():
     while True:
         try:
@@ -216,6 +280,18 @@ def cleanup_dead_peers():
             logger.error(f"Ошибка автоматической очистки пиров: {e}")
         time.sleep(TRACKER_PEER_CLEANUP_PERIOD)
 
+blocklist_cache = {'ips': frozenset(), 'info_hashes': frozenset()}
+
+def reload_blocklist():
+    rows = db.query("SELECT ip, info_hash FROM blocklist")
+    blocklist_cache['ips'] = frozenset(r['ip'] for r in rows if r['ip'])
+    blocklist_cache['info_hashes'] = frozenset(r['info_hash'] for r in rows if r['info_hash'])
+
+def is_blocked_cached(ip, info_hash):
+    return ip in blocklist_cache['ips'] or info_hash in blocklist_cache['info_hashes']
+
+reload_blocklist()
+
 def is_blocked(ip, info_hash):
     res = db.query(
         "SELECT 1 FROM blocklist WHERE (ip = ? AND ip != '') OR (info_hash = ? AND info_hash != '') LIMIT 1",
@@ -238,8 +314,44 @@ def status():
         logger.error(f"Ошибка проверки статуса: {e}")
         return Response("ERROR", mimetype='text/plain'), 500
 
+def build_announce(info_hash, numwant, now):
+    db_started = time.monotonic()
+    peers_query = db.query(
+        "SELECT ip, port, left, COUNT(*) OVER () AS swarm_size FROM tracker "
+        "WHERE info_hash = ? AND update_time > ? ORDER BY RANDOM() LIMIT ?",
+        (info_hash, now - load.peer_window(tr_cfg.announce_interval), numwant)
+    )
+    load.observe_db(time.monotonic() - db_started)
+
+    peers = []
+    complete = 0
+    incomplete = 0
+    swarm_size = peers_query[0]['swarm_size'] if peers_query else 0
+
+    for peer in peers_query:
+        if peer['left'] == 0:
+            complete += 1
+        else:
+            incomplete += 1
+        peers.append({
+            'ip': decode_ip(peer['ip']),
+            'port': peer['port']
+        })
+
+    interval = load.interval(tr_cfg.announce_interval, swarm_size)
+    output = {
+        'interval': interval,
+        'min interval': interval // 2,
+        'complete': complete,
+        'incomplete': incomplete,
+        'peers': peers
+    }
+    load.remember(info_hash, complete, incomplete, peers)
+    return bencode(output)
+
 @app.route('/announce')
 def announce():
+    load.begin()
     try:
         now = int(time.time())
         if tr_cfg.run_gc_key in request.args:
@@ -279,11 +391,6 @@ def announce():
             logger.warning(f"IP {ip} из ignore_ip — игнорируется")
             return Response(bencode({'failure reason': 'IP запрещён'}), mimetype='text/plain')
 
-        info_hash_hex = info_hash.hex() if isinstance(info_hash, bytes) else info_hash
-        if is_blocked(ip, info_hash_hex):
-            logger.warning(f"Блокировка: {ip} или {info_hash_hex}")
-            return Response(bencode({'failure reason': 'IP или торрент заблокирован'}), mimetype='text/plain')
-
         event = request.args.get('event', '')
         uploaded = int(request.args.get('uploaded', 0))
         downloaded = int(request.args.get('downloaded', 0))
@@ -292,46 +399,67 @@ def announce():
         no_peer_id = int(request.args.get('no_peer_id', 0))
         numwant = min(int(request.args.get('numwant', tr_cfg.numwant)), 200)
 
+        info_hash_hex = info_hash.hex() if isinstance(info_hash, bytes) else info_hash
         encoded_ip = encode_ip(ip)
-        db.query(
-            "REPLACE INTO tracker (info_hash, ip, port, left, update_time) VALUES (?, ?, ?, ?, ?)",
-            (info_hash, encoded_ip, port, left, now)
-        )
-        logger.debug(f"Сохранен пир: {ip}({encoded_ip}):{port}")
 
-        peers_query = db.query(
-            "SELECT ip, port, left FROM tracker WHERE info_hash = ? AND update_time > ? ORDER BY RANDOM() LIMIT ?",
-            (info_hash, now - tr_cfg.announce_interval, numwant)
-        )
+        # При перегрузке БД не трогаем: блоклист проверяется по копии в памяти
+        if load.should_shed():
+            if is_blocked_cached(ip, info_hash_hex):
+                logger.warning(f"Блокировка: {ip} или {info_hash_hex}")
+                return Response(bencode({'failure reason': 'IP или торрент заблокирован'}), mimetype='text/plain')
+            load.defer(info_hash, encoded_ip, port, left, now, event == 'stopped')
+            output = load.degraded_response(info_hash, tr_cfg.announce_interval)
+            logger.debug(f"Перегрузка: упрощённый ответ для {ip}:{port}, peers: {len(output['peers'])}")
+            return Response(bencode(output), mimetype='text/plain')
 
-        peers = []
-        complete = 0
-        incomplete = 0
+        if is_blocked(ip, info_hash_hex):
+            logger.warning(f"Блокировка: {ip} или {info_hash_hex}")
+            return Response(bencode({'failure reason': 'IP или торрент заблокирован'}), mimetype='text/plain')
 
-        for peer in peers_query:
-            if peer['left'] == 0:
-                complete += 1
-            else:
-                incomplete += 1
-            peers.append({
-                'ip': decode_ip(peer['ip']),
-                'port': peer['port']
-            })
-
-        output = {
-            'interval': tr_cfg.announce_interval,
-            'min interval': tr_cfg.announce_interval // 2,
-            'complete': complete,
-            'incomplete': incomplete,
-            'peers': peers
-        }
+        db_started = time.monotonic()
+        if event == 'stopped':
+            db.query(
+                "DELETE FROM tracker WHERE info_hash = ? AND ip = ? AND port = ?",
+                (info_hash, encoded_ip, port)
+            )
+            logger.debug(f"Удален пир: {ip}({encoded_ip}):{port}")
+        else:
+            db.query(
+                "REPLACE INTO tracker (info_hash, ip, port, left, update_time) VALUES (?, ?, ?, ?, ?)",
+                (info_hash, encoded_ip, port, left, now)
+            )
+            logger.debug(f"Сохранен пир: {ip}({encoded_ip}):{port}")
+        if cluster:
+            cluster.publish(OP_LEAVE if event == 'stopped' else OP_JOIN, info_hash, encoded_ip, port, left, now)
+
+        deferred = load.take_deferred()
+        if deferred:
+            db.query_many(
+                "INSERT INTO tracker (info_hash, ip, port, left, update_time) VALUES (?, ?, ?, ?, ?) "
+                "ON CONFLICT (info_hash, ip, port) DO UPDATE SET left = excluded.left, update_time = excluded.update_time "
+                "WHERE excluded.update_time >= tracker.update_time",
+                deferred
+            )
+            logger.debug(f"Записано отложенных пиров: {len(deferred)}")
+            if cluster:
+                for row in deferred:
+                    cluster.publish(OP_JOIN, *row)
 
-        logger.debug(f"Отправлен ответ для {ip}:{port}, peers: {len(peers)}, complete: {complete}, incomplete: {incomplete}")
-        return Response(bencode(output), mimetype='text/plain')
+        load.observe_db(time.monotonic() - db_started)
+
+        if TRACKER_ANNOUNCE_COALESCE:
+            body, shared = announce_flights.do((info_hash, numwant), lambda: build_announce(info_hash, numwant, now))
+        else:
+            body, shared = build_announce(info_hash, numwant, now), False
+
+        logger.debug(f"Отправлен ответ для {ip}:{port}{' (общий)' if shared else ''}")
+        return Response(body, mimetype='text/plain')
 
     except Exception as e:
         logger.error(f"Ошибка обработки announce запроса: {e}\n{traceback.format_exc()}")
         return Response(bencode({'failure reason': str(e)}), mimetype='text/plain')
+    finally:
+        load.end()
 
 @app.route('/scrape')
 def scrape():
@@ -445,6 +573,9 @@ def stats():
             'server_time': datetime.datetime.fromtimestamp(now).strftime('%Y-%m-%d %H:%M:%S'),
             'uptime': str(datetime.timedelta(seconds=int(time.time() - app.start_time))),
             'announce_interval': f"{tr_cfg.announce_interval} сек.",
+            'load': load.stats(),
+            'cluster': cluster.stats() if cluster else None,
+            'coalesce': announce_flights.stats(),
             'stats': total_stats[0] if total_stats else {},
             'top_torrents': [dict(t) for t in (top_torrents if top_torrents else [])],
             'db_size': db_size,
@@ -522,6 +653,7 @@ def blocklist():
                 "INSERT INTO blocklist (ip, info_hash, reason, created_at) VALUES (?, ?, ?, ?)",
                 (ip if ip else None, info_hash if info_hash else None, reason, int(time.time()))
             )
+            reload_blocklist()
             message = "Добавлено в блоклист"
     blocks = db.query("SELECT * FROM blocklist ORDER BY created_at DESC")
     return render_template('blocklist.html', blocks=blocks, message=message)
@@ -530,9 +662,27 @@ def blocklist():
 @login_required
 def unblock_blocklist(block_id):
     db.query("DELETE FROM blocklist WHERE id = ?", (block_id,))
+    reload_blocklist()
     flash("Запись разблокирована", "success")
     return redirect(url_for('blocklist'))
 
+@app.route('/profile')
+@login_required
+def profile():
+    try:
+        seconds = float(request.args.get('seconds', 10))
+        interval_ms = float(request.args.get('interval_ms', 10))
+        logger.info(f"Запущено профилирование на {seconds} сек.")
+        result = profiler.run(seconds, interval_ms / 1000, request.args.get('idle') == '1')
+    except ValueError:
+        return Response(json.dumps({'error': 'Некорректные параметры'}), mimetype='application/json'), 400
+    except ProfilerBusy:
+        return Response(json.dumps({'error': 'Профилирование уже выполняется'}), mimetype='application/json'), 409
+    logger.info(f"Профилирование завершено: {result['samples']} выборок, накладные расходы {result['overhead_pct']}%")
+    if request.args.get('format') == 'collapsed':
+        return Response(result['collapsed'] + '\n', mimetype='text/plain')
+    return Response(json.dumps(result, ensure_ascii=False), mimetype='application/json')
+
 @app.template_filter('datetime')
 def _jinja2_filter_datetime(ts):
     if not ts:
@@ -543,7 +693,10 @@ def _jinja2_filter_datetime(ts):
         return str(ts)
 
 if __name__ == '__main__':
-    threading.Thread(target=cleanup_dead_peers, daemon=True).start()
+    threading.Thread(target=cleanup_dead_peers, daemon=True, name='cleanup_dead_peers').start()
+    # При включенном reloader порт кластера занимает только дочерний процесс
+    if cluster and (not TRACKER_USE_RELOADER or os.environ.get('WERKZEUG_RUN_MAIN') == 'true'):
+        cluster.start()
 
     def is_valid_ip(ip):
         try:
@@ -0,0 +1,132 @@
+import os
+import re
+import sys
+import math
+import time
+import threading
+from collections import Counter
+from typing import Dict, Any
+
+
+# Листовые кадры потоков, которые спят или ждут ввода: select, sleep, recvfrom, Event.wait
+IDLE_FRAMES = {
+    ('select', 'selectors.py'),
+    ('wait', 'threading.py'),
+    ('_wait_for_tstate_lock', 'threading.py'),
+    ('accept', 'socket.py'),
+    ('cleanup_dead_peers', 'main.py'),
+    ('_flush_loop', 'cluster.py'),
+    ('_receive_loop', 'cluster.py')
+}
+
+THREAD_NUMBER_RE = re.compile(r'^Thread-\d+(?: \((.+)\))?$')
+
+
+class ProfilerBusy(Exception):
+    pass
+
+
+class SamplingProfiler:
+    def __init__(self, config: Dict):
+        self.cfg = {
+            'max_seconds': 30,
+            'min_interval': 0.005,
+            'max_overhead': 0.05,
+            'max_depth': 64,
+            'top': 30,
+            'include_idle': False
+        }
+        self.cfg.update(config)
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def _thread_group(name: str) -> str:
+        # Werkzeug создает поток Thread-N на каждый запрос; без номера стеки разных запросов сливаются
+        match = THREAD_NUMBER_RE.match(name)
+        if match:
+            return match.group(1) or 'Thread'
+        return name
+
+    @staticmethod
+    def _is_idle(frame) -> bool:
+        code = frame.f_code
+        return (code.co_name, os.path.basename(code.co_filename)) in IDLE_FRAMES
+
+    @staticmethod
+    def _label(frame) -> str:
+        code = frame.f_code
+        return f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})"
+
+    def run(self, seconds: float, interval: float, include_idle: bool = None) -> Dict[str, Any]:
+        if not (math.isfinite(seconds) and math.isfinite(interval)):
+            raise ValueError('seconds and interval must be finite')
+        # Одновременно допускается только один сеанс профилирования
+        if not self.lock.acquire(blocking=False):
+            raise ProfilerBusy()
+        try:
+            if include_idle is None:
+                include_idle = self.cfg['include_idle']
+            return self._sample(seconds, interval, include_idle)
+        finally:
+            self.lock.release()
+
+    def _sample(self, seconds: float, interval: float, include_idle: bool) -> Dict[str, Any]:
+        seconds = min(max(seconds, 0.1), self.cfg['max_seconds'])
+        interval = min(max(interval, self.cfg['min_interval']), seconds)
+        own_ident = threading.get_ident()
+        stacks = Counter()
+        self_counts = Counter()
+        total_counts = Counter()
+        samples = 0
+        idle_samples = 0
+        busy = 0.0
+        started = time.monotonic()
+        deadline = started + seconds
+
+        while time.monotonic() < deadline:
+            tick = time.monotonic()
+            names = {t.ident: self._thread_group(t.name) for t in threading.enumerate()}
+            for ident, frame in sys._current_frames().items():
+                if ident == own_ident:
+                    continue
+                if not include_idle and self._is_idle(frame):
+                    idle_samples += 1
+                    continue
+                labels = []
+                while frame is not None and len(labels) < self.cfg['max_depth']:
+                    labels.append(self._label(frame))
+                    frame = frame.f_back
+                if not labels:
+                    continue
+                labels.reverse()
+                stacks[';'.join([names.get(ident, str(ident))] + labels)] += 1
+                self_counts[labels[-1]] += 1
+                for label in set(labels):
+                    total_counts[label] += 1
+            samples += 1
+            cost = time.monotonic() - tick
+            busy += cost
+            # Шаг растягивается так, чтобы сбор стеков занимал не больше max_overhead времени
+            step = max(interval, cost / self.cfg['max_overhead']) - cost
+            time.sleep(max(min(step, deadline - time.monotonic()), 0))
+
+        elapsed = time.monotonic() - started
+        thread_samples = sum(stacks.values()) or 1
+        top = []
+        for label, count in self_counts.most_common(self.cfg['top']):
+            top.append({
+                'function': label,
+                'self': count,
+                'self_pct': round(100.0 * count / thread_samples, 1),
+                'total': total_counts[label],
+                'total_pct': round(100.0 * total_counts[label] / thread_samples, 1)
+            })
+        return {
+            'seconds': round(elapsed, 2),
+            'interval_ms': round(interval * 1000, 1),
+            'samples': samples,
+            'idle_samples': idle_samples,
+            'overhead_pct': round(100.0 * busy / elapsed, 2) if elapsed else 0,
+            'top': top,
+            'collapsed': '\n'.join(f"{stack} {count}" for stack, count in stacks.most_common())
+        }